@@ -19,24 +19,139 @@ import os
 import sys
 import argparse
 import filecmp
-from json import dump as jdump
-from hashlib import sha256
+import mmap
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from json import JSONEncoder
+from hashlib import sha256, blake2b
+
+
+# hashing threads; sha256 releases the GIL, so threads scale with the cores.
+# Capped, as ThreadPoolExecutor's own default is
+HASH_WORKERS = min(32, os.cpu_count() or 1)
+# files smaller than SMALL_FILE_SIZE are handed to the pool in batches of
+# HASH_BATCH_SIZE files, to amortize the per-task overhead
+SMALL_FILE_SIZE = 65536
+HASH_BATCH_SIZE = 16
+# hashing only this many files (or less) is not worth starting a pool for
+MIN_POOL_FILES = 2
+# directory trees are walked in parallel only if the top level has at least
+# this many subdirectories, otherwise starting the threads is not worth it
+PARALLEL_WALK_MIN_DIRS = 4
+WALK_WORKERS = 8
+
+# digests computed during one comparison, keyed by (st_dev, st_ino, st_size,
+# st_mtime_ns, st_ctime_ns), so hardlinked files and directories compared
+# against themselves are hashed only once. main() empties it for every run;
+# the ctime in the key also catches files rewritten with a restored mtime
+_digest_cache = {}
+
+
+_JSON_ENCODER = JSONEncoder(indent=2, sort_keys=False, separators=(',', ':'), ensure_ascii=False)
 
 
 class comparisonException(Exception):
     """Raise this when error"""
 
 
+def _hash_one(filepath, blocksize=65536, size=None):
+    """
+    Hash a single file with the algorithm selected by set_hash_algorithm
+    (sha256 by default), returns the raw digest. Used by both fileInfo and the
+    hashing thread pool. If the size of the file is known and it fits in one
+    block, the file is read directly
+    """
+    try:
+        hasher = fileInfo._hasher_ctor()
+        with open(filepath, 'rb', buffering=0) as f_d:
+            mapped = None
+            # for files that fit in one block the fadvise, mmap and munmap
+            # syscalls cost more than they save
+            if size is None or size >= blocksize:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f_d.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                # map the whole file and hash it with a single update, so
+                # hashlib reads straight from the page cache. Opt-in, as a
+                # file truncated while being hashed kills the process with
+                # SIGBUS instead of raising an error
+                if fileInfo.use_mmap:
+                    try:
+                        mapped = mmap.mmap(f_d.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (ValueError, OSError, OverflowError):
+                        # empty and special files cannot be mapped
+                        pass
+            if mapped is not None:
+                with mapped:
+                    hasher.update(mapped)
+            else:
+                # unbuffered reads straight into one reused buffer: one read()
+                # syscall per block and no new bytes object for every block
+                buf = bytearray(blocksize)
+                view = memoryview(buf)
+                read_bytes = f_d.readinto(buf)
+                while read_bytes:
+                    hasher.update(view[:read_bytes])
+                    read_bytes = f_d.readinto(buf)
+    except IOError as ierr:
+        raise comparisonException(ierr)
+    return hasher.digest()
+
+
+def _hash_batch(files, blocksize=65536):
+    """
+    Hash a batch of (filepath, size) pairs in one pool task, returns a list
+    of digests
+    """
+    return [_hash_one(filepath, blocksize, size) for filepath, size in files]
+
+
+def _scan_dir(path, prefix):
+    """
+    List one directory with os.scandir, returns the (relative path, DirEntry)
+    pairs of its files and the (path, relative path prefix) pairs of its
+    subdirectories. Like os.walk, unreadable directories are skipped,
+    symlinks to directories are not followed, and entries that cannot be
+    stat'ed (e.g. symlink loops) are listed as files
+    """
+    files = []
+    subdirs = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return files, subdirs
+    for entry in entries:
+        rel_path = prefix + entry.name
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = False
+            if not is_symlink:
+                subdirs.append((entry.path, rel_path + os.sep))
+        else:
+            files.append((rel_path, entry))
+    return files, subdirs
+
+
 class dirInfo(object):
     """
     Directory to analyze as an object. Contains a list of files in directory
     (recursive) and a dictionary of fileInfo object of each file
     """
+    __slots__ = ('dirpath', 'blocksize', 'files_in_dir', 'dir_entries',
+                 'file_infos', 'dict_of_hashes', 'skip_files_list')
 
     def __init__(self, dirpath, blocksize=65536, skip_files_list=None):
         """Return dirInfo object"""
         self.dirpath = dirpath
         self.blocksize = blocksize
+        self.files_in_dir = None
+        # os.DirEntry of each file, these cache the stat of the file
+        self.dir_entries = {}
         self.files_in_dir = self.get_files_in_dir()
         # we initialize the dict of hashes empty
         self.file_infos = {}
@@ -45,81 +160,219 @@ class dirInfo(object):
 
     def get_files_in_dir(self):
         """
-        wrapper for os.walk and os.path to get the relative paths of filesi
+        Walk the directory with os.scandir to get the relative paths of files,
+        the listing is cached after the first walk. Subdirectories are scanned
+        in a thread pool when the top level has enough of them
         """
+        if self.files_in_dir is not None:
+            return self.files_in_dir
         files_in_dir = []
         try:
-            for root, _dirs, files in os.walk(self.dirpath):
-                for current_file in files:
-                    files_in_dir.append(
-                        os.path.relpath(
-                            os.path.join(root, current_file), self.dirpath))
+            files, pending = _scan_dir(self.dirpath, '')
+            self._add_scanned_files(files, files_in_dir)
+            if len(pending) >= PARALLEL_WALK_MIN_DIRS:
+                with ThreadPoolExecutor(max_workers=WALK_WORKERS) as ex:
+                    running = {ex.submit(_scan_dir, path, prefix) for path, prefix in pending}
+                    while running:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            files, subdirs = future.result()
+                            self._add_scanned_files(files, files_in_dir)
+                            running.update(ex.submit(_scan_dir, path, prefix) for path, prefix in subdirs)
+            else:
+                pending = deque(pending)
+                while pending:
+                    files, subdirs = _scan_dir(*pending.popleft())
+                    self._add_scanned_files(files, files_in_dir)
+                    pending.extend(subdirs)
         except Exception as cex:
             raise comparisonException(cex)
         return files_in_dir
 
-    def generate_fileInfo_objects(self):
-        """Generate fileInfo objects for files in directory structure"""
+    def _add_scanned_files(self, files, files_in_dir):
+        """Store the files found by _scan_dir"""
+        for rel_path, entry in files:
+            files_in_dir.append(rel_path)
+            self.dir_entries[rel_path] = entry
+
+    def generate_fileInfo_objects(self, files=None):
+        """Generate fileInfo objects for files in directory structure (or only
+        for the given relative file names), existing objects are kept"""
         if not self.skip_files_list:
             self.skip_files_list = []
-        for file_in_dir in self.files_in_dir:
-            if file_in_dir not in self.skip_files_list:
-                self.file_infos[file_in_dir] = fileInfo(
-                    os.path.join(self.dirpath, file_in_dir), self.blocksize)
+        if files is None:
+            files = self.files_in_dir
+        skip_files = set(self.skip_files_list)
+        skip_files.update(self.file_infos)
+        self.file_infos.update({
+            file_in_dir: fileInfo(os.path.join(self.dirpath, file_in_dir), self.blocksize,
+                                  self.dir_entries.get(file_in_dir))
+            for file_in_dir in files if file_in_dir not in skip_files})
         return self.file_infos
 
-    def generate_hashes(self):
-        """Generate hashes for all files in directory structure,
-        returning a dict of relative file name and its hash"""
+    def generate_hashes(self, files_to_hash=None):
+        """Generate hashes for all files in directory structure (or only for
+        files_to_hash, if given), returning a dict of relative file name and
+        its hash"""
         if not self.skip_files_list:
             self.skip_files_list = []
-        if not self.file_infos:
-            self.generate_fileInfo_objects()
+        if files_to_hash is None:
+            files_to_hash = self.files_in_dir
+        self.generate_fileInfo_objects(files_to_hash)
+        to_hash = []
+        same_inode = []
+        seen = set()
+        for fi in files_to_hash:
+            if fi not in self.file_infos:
+                continue
+            file_info = self.file_infos[fi]
+            if file_info.stat is None or file_info.hash:
+                continue
+            key = file_info.cache_key()
+            if key in _digest_cache:
+                file_info.hash = _digest_cache[key]
+            elif key is not None and key in seen:
+                same_inode.append(fi)
+            else:
+                seen.add(key)
+                to_hash.append(fi)
+        if len(to_hash) <= MIN_POOL_FILES:
+            for fi in to_hash:
+                self.file_infos[fi].get_digest()
+        else:
+            self._hash_in_pool(to_hash)
+            for fi in to_hash:
+                key = self.file_infos[fi].cache_key()
+                if key is not None:
+                    _digest_cache[key] = self.file_infos[fi].hash
+        for fi in same_inode:
+            self.file_infos[fi].hash = _digest_cache[self.file_infos[fi].cache_key()]
         for fi in self.file_infos:
-            if os.path.isfile(self.file_infos[fi].filepath):
-                self.dict_of_hashes[fi] = self.file_infos[fi].get_sha256_hash()
+            if self.file_infos[fi].hash:
+                self.dict_of_hashes[fi] = self.file_infos[fi].hash
         return self.dict_of_hashes
 
+    def _hash_in_pool(self, to_hash):
+        """
+        Hash the given files in a thread pool. Small files are grouped into batches
+        to amortize the per-task overhead, large files get a task of their own
+        """
+        batches = []
+        batch = []
+        for fi in to_hash:
+            if self.file_infos[fi].stat.st_size >= SMALL_FILE_SIZE:
+                batches.append([fi])
+                continue
+            batch.append(fi)
+            if len(batch) == HASH_BATCH_SIZE:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as ex:
+            results = ex.map(_hash_batch,
+                             [[(self.file_infos[fi].filepath, self.file_infos[fi].stat.st_size) for fi in b]
+                              for b in batches],
+                             [self.blocksize] * len(batches))
+            for batch, file_hashes in zip(batches, results):
+                for fi, file_hash in zip(batch, file_hashes):
+                    self.file_infos[fi].hash = file_hash
+
 
 class fileInfo(object):
     """
-    File object containing information, such as sha256 hash and stat.
-    sha256 hash is not generated during init, but can be generated and
-    stored in the object later
+    File object containing information, such as hash digest and stat.
+    The digest is not generated during init, but can be generated and
+    stored in the object later. There is one per file, so __slots__ keeps
+    them small
     """
-    def __init__(self, filepath, blocksize=65536):
+    __slots__ = ('filepath', 'blocksize', 'hash', 'stat')
+    # hashlib's sha256 is OpenSSL's, which picks SHA-NI/AVX2 code at runtime
+    _hasher_ctor = staticmethod(sha256)
+    hash_algorithm = "sha256"
+    # hash via memory maps, only safe for trees that are not being modified
+    use_mmap = False
+
+    def __init__(self, filepath, blocksize=65536, dir_entry=None):
         self.filepath = filepath
         self.blocksize = blocksize
-        self.hash = ""
-        self.stat = self.get_posix_stat()
+        self.hash = b""
+        self.stat = self.get_posix_stat(dir_entry)
 
-    def get_sha256_hash(self):
+    def get_digest(self):
         """
-        Compute SHA256 hash of a file, with configurable blocksize
-        (defaults to 65536)
+        Compute the raw digest of a file with the algorithm selected by
+        set_hash_algorithm (sha256 by default, a 32-byte digest), with
+        configurable blocksize (defaults to 65536). Use .hex() on it for the
+        hexdigest
         """
         # don't compute the hash again:
         if not self.hash:
-            try:
-                sha256hasher = sha256()
-                with open(self.filepath, 'rb') as f_d:
-                    buf = f_d.read(self.blocksize)
-                    while len(buf) > 0:
-                        sha256hasher.update(buf)
-                        buf = f_d.read(self.blocksize)
-                    self.hash = sha256hasher.hexdigest()
-            except IOError as ierr:
-                raise comparisonException(ierr)
+            key = self.cache_key()
+            if key in _digest_cache:
+                self.hash = _digest_cache[key]
+            else:
+                self.hash = _hash_one(self.filepath, self.blocksize, self.stat.st_size if self.stat else None)
+                if key is not None:
+                    _digest_cache[key] = self.hash
         return self.hash
 
-    def get_posix_stat(self):
-        '''Get POSIX stat of file'''
+    def cache_key(self):
+        """
+        Key of the file in the digest cache, None if the file
+        cannot be cached (not a regular file, or no inode numbers available)
+        """
+        if self.stat is None or not self.stat.st_ino:
+            return None
+        return (self.stat.st_dev, self.stat.st_ino, self.stat.st_size,
+                self.stat.st_mtime_ns, self.stat.st_ctime_ns)
+
+    def get_posix_stat(self, dir_entry=None):
+        '''Get POSIX stat of file, from its os.DirEntry if one is given'''
+        if dir_entry is not None:
+            # like os.path.isfile, treat entries that cannot be stat'ed (e.g.
+            # symlink loops, or files removed since listing) as non-files
+            try:
+                if dir_entry.is_file():
+                    return dir_entry.stat()
+            except OSError:
+                pass
+            return None
         if os.path.isfile(self.filepath):
             return os.stat(self.filepath)
         else:
             return None
 
 
+def set_hash_algorithm(algorithm="sha256"):
+    """
+    Select the hash used for file digests: sha256 (default), or a faster one
+    for plain change detection. blake2b is in the standard library, blake3 and
+    xxh3 need the blake3 and xxhash packages respectively
+    """
+    if algorithm == "sha256":
+        hasher_ctor = sha256
+    elif algorithm == "blake2b":
+        hasher_ctor = blake2b
+    elif algorithm == "blake3":
+        try:
+            from blake3 import blake3 as hasher_ctor
+        except ImportError:
+            raise comparisonException("Hashing with blake3 requires the blake3 package")
+    elif algorithm == "xxh3":
+        try:
+            from xxhash import xxh3_128 as hasher_ctor
+        except ImportError:
+            raise comparisonException("Hashing with xxh3 requires the xxhash package")
+    else:
+        raise comparisonException("Unknown hash algorithm {0}".format(algorithm))
+    if algorithm != fileInfo.hash_algorithm:
+        # digests of different algorithms must not be mixed
+        _digest_cache.clear()
+    fileInfo._hasher_ctor = staticmethod(hasher_ctor)
+    fileInfo.hash_algorithm = algorithm
+
+
 def compare_directories(orig_dir_files, new_dir_files):
     """
     Compare the contents of two directories to see what file names exist only
@@ -127,20 +380,22 @@ def compare_directories(orig_dir_files, new_dir_files):
     and orig_dir.
     """
     try:
-        orig_only_files = [orig_file for orig_file in orig_dir_files if orig_file not in new_dir_files]
-        new_files = [new_file for new_file in new_dir_files if new_file not in orig_dir_files]
-        common_files = [common_file for common_file in new_dir_files if common_file in orig_dir_files]
+        orig_set = set(orig_dir_files)
+        new_set = set(new_dir_files)
+        orig_only_files = sorted(orig_set - new_set)
+        new_files = sorted(new_set - orig_set)
+        common_files = sorted(orig_set & new_set)
     except Exception as cex:
         raise comparisonException(cex)
     return orig_only_files, new_files, common_files
 
-def compare_files(orig_file_infos, new_file_infos, files_to_compare, type_of_comparison="stat"):
+def compare_files(orig_file_infos, new_file_infos, files_to_compare, type_of_comparison="stat", shallow=False):
     """Wrapper for _compare_fileinfos, i.e. compare fileInfo objects"""
     changed = []
     unchanged = []
     for file_to_cmp in files_to_compare:
         try:
-            if _compare_fileinfos(orig_file_infos[file_to_cmp], new_file_infos[file_to_cmp], type_of_comparison):
+            if _compare_fileinfos(orig_file_infos[file_to_cmp], new_file_infos[file_to_cmp], type_of_comparison, shallow):
                 unchanged.append(file_to_cmp)
             else:
                 changed.append(file_to_cmp)
@@ -151,69 +406,164 @@ def compare_files(orig_file_infos, new_file_infos, files_to_compare, type_of_com
 
 def _compare_fileinfos(orig_file_info, new_file_info, type_of_comparison, shallow=False):
     """
-    Compare files using filecmp.cmp (shallow or not [default]) or by hash, returns True if the files are the same (as deemed by the comparison operation).
+    Compare files using filecmp.cmp (contents) or by hash, returns True if the files are the same (as deemed by the comparison operation).
+    Either way, files of different size are never read, and with shallow=True
+    files with identical size, mtime and mode are trusted to be the same
+    without reading them.
     @input fileInfo object
     """
     if not isinstance(orig_file_info, fileInfo) or not isinstance(new_file_info, fileInfo):
         raise comparisonException("Trying to compare non-fileInfo objects")
 
     if type_of_comparison == "stat":
+        # decide by the same stat signature as the hash comparison, rather
+        # than filecmp's own shallow signature which ignores the mode
+        same_stat = _compare_stats(orig_file_info, new_file_info, shallow)
+        if same_stat is not None:
+            return same_stat
         try:
-            same_file = filecmp.cmp(orig_file_info.filepath, new_file_info.filepath, shallow)
+            same_file = filecmp.cmp(orig_file_info.filepath, new_file_info.filepath, False)
         except OSError as oerr:
             raise comparisonException("{0}{1}".format(oerr.errno, oerr.message))
     elif type_of_comparison == "hash":
+        same_stat = _compare_stats(orig_file_info, new_file_info, shallow)
+        if same_stat is not None:
+            return same_stat
         try:
-            same_file = bool(str(orig_file_info.get_sha256_hash()) == str(new_file_info.get_sha256_hash()))
+            same_file = orig_file_info.get_digest() == new_file_info.get_digest()
         except OSError as oerr:
             raise comparisonException("{0}{1}".format(oerr.errno, oerr.message))
     else:
         raise comparisonException("Possibly unknown comparison type {0}?".format(type_of_comparison))
     return same_file
 
+def _compare_stats(orig_file_info, new_file_info, shallow=False):
+    """
+    Decide the comparison of two fileInfo objects from their stats alone:
+    returns False if the sizes differ, True if shallow and size, mtime and
+    mode all match, and None if the files need to be hashed
+    """
+    orig_stat = orig_file_info.stat
+    new_stat = new_file_info.stat
+    if orig_stat is None or new_stat is None:
+        return None
+    if orig_stat.st_size != new_stat.st_size:
+        return False
+    if shallow and (orig_stat.st_mtime, orig_stat.st_mode) == (new_stat.st_mtime, new_stat.st_mode):
+        return True
+    return None
+
+def _files_needing_hash(orig_file_infos, new_file_infos, files_to_compare, shallow=False):
+    """List the files whose comparison cannot be decided by _compare_stats"""
+    return [file_to_cmp for file_to_cmp in files_to_compare
+            if file_to_cmp in orig_file_infos and file_to_cmp in new_file_infos
+            and _compare_stats(orig_file_infos[file_to_cmp], new_file_infos[file_to_cmp], shallow) is None]
+
+def _files_by_size(dir_obj):
+    """
+    Group the regular files of a dirInfo object by their size, using the
+    stats cached in its os.DirEntry objects instead of creating fileInfo
+    objects for files that might never be hashed
+    """
+    skip_files = set(dir_obj.skip_files_list or ())
+    by_size = defaultdict(list)
+    for fi, entry in dir_obj.dir_entries.items():
+        if fi in skip_files:
+            continue
+        # skip entries that cannot be stat'ed, as fileInfo.get_posix_stat does
+        try:
+            if entry.is_file():
+                by_size[entry.stat().st_size].append(fi)
+        except OSError:
+            pass
+    return by_size
+
 def compare_full_dirs(orig_dir_obj, new_dir_obj):
     """Compare every file in the two directories by hashes"""
     # generate hashes for all files and store into object
-    print("Computing sha256 hashes for full directories can take a long time!")
-    print("Computing sha256 hashes for {0}...".format(orig_dir_obj.dirpath))
-    orig_dir_obj.generate_hashes()
-    print("Computing sha256 hashes for {0}...".format(new_dir_obj.dirpath))
-    new_dir_obj.generate_hashes()
-    print("Computing differences via sha256 hashes...")
-    common_hashes = set(orig_dir_obj.dict_of_hashes.values()) & set(orig_dir_obj.dict_of_hashes.values())
-
-    hash_map = {}
-    unchanged = []
-    for ch in common_hashes:
-        found_in_orig = [k for k, v in orig_dir_obj.dict_of_hashes.iteritems() if v == ch]
-        found_in_new = [k for k, v in new_dir_obj.dict_of_hashes.iteritems() if v == ch]
-        # intersection of the two lists above is the unchanged files
-        unchanged.extend(list(set(found_in_orig).intersection(found_in_new)))
-        # dictionary containing hash and the corresponding files in both
-        # directories
-        hash_map[ch] = {\
-                        orig_dir_obj.dirpath: found_in_orig,\
-                        new_dir_obj.dirpath: found_in_new\
-                        }
-    # we have now found the common files by sha256 hash. All other files can
+    print("Computing {0} hashes for full directories can take a long time!".format(fileInfo.hash_algorithm))
+    # a file can only have an identical twin in the other directory if there
+    # is a file of the same size there, so the rest need not be hashed at all
+    orig_sizes = _files_by_size(orig_dir_obj)
+    new_sizes = _files_by_size(new_dir_obj)
+    shared_sizes = orig_sizes.keys() & new_sizes.keys()
+    print("Computing {0} hashes for {1}...".format(fileInfo.hash_algorithm, orig_dir_obj.dirpath))
+    orig_dir_obj.generate_hashes([fi for size in shared_sizes for fi in orig_sizes[size]])
+    print("Computing {0} hashes for {1}...".format(fileInfo.hash_algorithm, new_dir_obj.dirpath))
+    new_dir_obj.generate_hashes([fi for size in shared_sizes for fi in new_sizes[size]])
+    print("Computing differences via {0} hashes...".format(fileInfo.hash_algorithm))
+    # invert the dicts of hashes once, so that files with a given hash can be
+    # looked up directly
+    orig_by_hash = defaultdict(list)
+    for k, v in orig_dir_obj.dict_of_hashes.items():
+        orig_by_hash[v].append(k)
+    new_by_hash = defaultdict(list)
+    for k, v in new_dir_obj.dict_of_hashes.items():
+        new_by_hash[v].append(k)
+    common_hashes = orig_by_hash.keys() & new_by_hash.keys()
+
+    # a file is unchanged if it has the same hash under the same path in both
+    # directories, which is a single dict lookup per file
+    orig_hashes = orig_dir_obj.dict_of_hashes
+    unchanged = sorted(fi for fi, fh in new_dir_obj.dict_of_hashes.items() if orig_hashes.get(fi) == fh)
+    # dictionary containing hash and the corresponding files in both
+    # directories
+    hash_map = {ch: {orig_dir_obj.dirpath: orig_by_hash[ch], new_dir_obj.dirpath: new_by_hash[ch]}
+                for ch in common_hashes}
+    # we have now found the common files by hash. All other files can
     # be considered as changed or new
-    changed_or_new = list(set(new_dir_obj.files_in_dir).symmetric_difference(unchanged))
+    changed_or_new = sorted(set(new_dir_obj.files_in_dir).difference(unchanged))
     return changed_or_new, unchanged, hash_map
 
+def _write_JSON_value(json_file, value, level=0):
+    """
+    Stream a value to an open JSON file, laid out as json.dump(indent=2) would
+    at the given nesting level. Dicts and lists are written item by item, and
+    bytes dict keys (digests) as hex, so the hash mapping is never copied or
+    encoded into one string
+    """
+    if isinstance(value, dict) and value:
+        separator = '{'
+        for key, item in value.items():
+            if isinstance(key, bytes):
+                key = key.hex()
+            json_file.write(separator + '\n' + '  ' * (level + 1))
+            json_file.write(_JSON_ENCODER.encode(key) + ':')
+            _write_JSON_value(json_file, item, level + 1)
+            separator = ','
+        json_file.write('\n' + '  ' * level + '}')
+    elif isinstance(value, (list, tuple)) and value:
+        separator = '['
+        for item in value:
+            json_file.write(separator + '\n' + '  ' * (level + 1))
+            _write_JSON_value(json_file, item, level + 1)
+            separator = ','
+        json_file.write('\n' + '  ' * level + ']')
+    else:
+        json_file.write(_JSON_ENCODER.encode(value))
+
 def write_to_JSON(result, outfile):
     """Write parsed query result (a Python dict) to JSON file"""
     try:
         with open(outfile, 'w') as json_file:
-            jdump(result, json_file, indent=2, sort_keys=False, separators=(',', ':'), ensure_ascii=False)
+            _write_JSON_value(json_file, result)
     except IOError as err:
         raise comparisonException('Writing JSON output to {of} failed with error {ec}.'.format(of=outfile, ec=err))
 
-def main(orig_dir, new_dir, blocksize, comparison_operator):
+def main(orig_dir, new_dir, blocksize, comparison_operator, trust_mtime=False, fast_hash=None, use_mmap=False):
     """ main source of pain """
+    # digests cached by an earlier run in this process may be stale
+    _digest_cache.clear()
+    if fast_hash and comparison_operator == "filecmp":
+        raise comparisonException("A fast hash can only be used with -common or -sha256")
+    set_hash_algorithm(fast_hash or "sha256")
+    fileInfo.use_mmap = use_mmap
     if not os.path.isdir(orig_dir):
         raise comparisonException("Directory {d} does not exist".format(d=orig_dir))
     if not os.path.isdir(new_dir):
         raise comparisonException("Directory {d} does not exist".format(d=new_dir))
+    if blocksize <= 0:
+        raise comparisonException("Blocksize must be positive, got {b}".format(b=blocksize))
 
     changed_files = []
     unchanged_files = []
@@ -223,27 +573,32 @@ def main(orig_dir, new_dir, blocksize, comparison_operator):
     orig_dir_obj = dirInfo(orig_dir, blocksize)
     print("Listing files in {0}".format(new_dir))
     new_dir_obj = dirInfo(new_dir, blocksize)
-    # fileInfo objects:
-    print("Generating information of files in {0}".format(orig_dir))
-    orig_dir_file_objs = orig_dir_obj.generate_fileInfo_objects()
-    print("Generating information of files in {0}".format(new_dir))
-    new_dir_file_objs = new_dir_obj.generate_fileInfo_objects()
     print("Comparing the contents of {od} and {nd}".format(od=orig_dir, nd=new_dir))
-    orig_files, new_files, common_files = compare_directories(orig_dir_obj.get_files_in_dir(), new_dir_obj.get_files_in_dir())
+    orig_files, new_files, common_files = compare_directories(orig_dir_obj.files_in_dir, new_dir_obj.files_in_dir)
+    if comparison_operator != "sha256":
+        # fileInfo objects are needed only for the files that are compared,
+        # in sha256 mode they are created when hashing
+        print("Generating information of common files in {od} and {nd}".format(od=orig_dir, nd=new_dir))
+        orig_dir_file_objs = orig_dir_obj.generate_fileInfo_objects(common_files)
+        new_dir_file_objs = new_dir_obj.generate_fileInfo_objects(common_files)
 
     if comparison_operator == "sha256":
-        print("Checking differences between ALL files in both directories via sha256 hashes... This might take a while!")
+        print("Checking differences between ALL files in both directories via {0} hashes... This might take a while!".format(fileInfo.hash_algorithm))
         #print("Comparing common files by their hashes...")
         # compare existing files by their hashes:
         changed_files, unchanged_files, hashmapping = compare_full_dirs(orig_dir_obj, new_dir_obj)
     elif comparison_operator == "common_only":
-        print("Comparing common files by their sha256 hashes")
+        print("Comparing common files by their {0} hashes".format(fileInfo.hash_algorithm))
+        # hash the files the stats cannot decide up front, in the hashing pools
+        files_to_hash = _files_needing_hash(orig_dir_file_objs, new_dir_file_objs, common_files, trust_mtime)
+        orig_dir_obj.generate_hashes(files_to_hash)
+        new_dir_obj.generate_hashes(files_to_hash)
         #changed_files, unchanged_files = _compare_files(orig)
-        changed_files, unchanged_files = compare_files(orig_dir_file_objs, new_dir_file_objs, common_files, "hash")
+        changed_files, unchanged_files = compare_files(orig_dir_file_objs, new_dir_file_objs, common_files, "hash", trust_mtime)
         hashmapping = None
     elif comparison_operator == "filecmp":
         print("Comparing common files via filecmp.cmp")
-        changed_files, unchanged_files = compare_files(orig_dir_file_objs, new_dir_file_objs, common_files, "stat")
+        changed_files, unchanged_files = compare_files(orig_dir_file_objs, new_dir_file_objs, common_files, "stat", trust_mtime)
         hashmapping = None
     else:
         raise comparisonException("Unknown comparison operator: {0}".format(comparison_operator))
@@ -260,12 +615,15 @@ if __name__ == "__main__":
     # optional arguments
     parser.add_argument('-o', '--path-to-original', help='Path to directory containing original files (e.g. older OS version)', type=str, dest='orig_dir')
     parser.add_argument('-n', '--path-to-new', help='Path to directory containing new files (e.g. newer OS version)', type=str, dest='new_dir')
-    parser.add_argument('-b', '--blocksize', help="Blocksize for sha256", type=int, default=65536, dest='blocksize')
+    parser.add_argument('-b', '--blocksize', help="Blocksize for hashing", type=int, default=65536, dest='blocksize')
     parser.add_argument('-s', '--save-output', help='Save output to a JSON file', type=str, dest='outfile')
+    parser.add_argument('-t', '--trust-mtime', action='store_true', help='Consider files with the same size, mtime and mode unchanged without reading them (-filecmp and -common only)', dest='trust_mtime')
+    parser.add_argument('-f', '--fast-hash', choices=['blake2b', 'blake3', 'xxh3'], help='Hash with a faster algorithm than sha256, with -common or -sha256 only (blake3 and xxh3 need the blake3 or xxhash package)', dest='fast_hash')
+    parser.add_argument('-m', '--mmap', action='store_true', help='Hash files via memory maps; faster, but only safe if the directories are not being modified, as a file truncated while being hashed crashes the tool', dest='use_mmap')
     parser.add_argument('-v', '--verbose', action='count', help='Print output', dest='verbosity')
     comparison_operator_group.add_argument("-filecmp", action="store_const", dest="comparison_operator", help="Compare using filecmp only", const="filecmp", default="filecmp")
-    comparison_operator_group.add_argument("-common", action="store_const", dest="comparison_operator", help="Compare using filecmp and use sha256 has for common files", const="common_only")
-    comparison_operator_group.add_argument("-sha256", action="store_const", dest="comparison_operator", help="Compare by sha256 only", const="sha256")
+    comparison_operator_group.add_argument("-common", action="store_const", dest="comparison_operator", help="Compare common files by their hashes (sha256 unless -f is given)", const="common_only")
+    comparison_operator_group.add_argument("-sha256", action="store_const", dest="comparison_operator", help="Compare all files by their hashes (sha256 unless -f is given)", const="sha256")
     args = parser.parse_args()
 
     if not args.verbosity and not args.outfile:
@@ -273,7 +631,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        only_in_orig, are_new, are_common, have_changed, are_unchanged, hashmap = main(args.orig_dir, args.new_dir, args.blocksize, args.comparison_operator)
+        only_in_orig, are_new, are_common, have_changed, are_unchanged, hashmap = main(args.orig_dir, args.new_dir, args.blocksize, args.comparison_operator, args.trust_mtime, args.fast_hash, args.use_mmap)
     except comparisonException as ex:
         print("Comparison failed with error: {e}".format(e=ex))
         sys.exit(1)
@@ -316,7 +674,7 @@ if __name__ == "__main__":
         try:
             print("Saving results to {sf}...".format(sf=args.outfile))
             if hashmap:
-                result_dict = {"directories":[args.new_dir, args.orig_dir], "new_files":are_new, "common_files":are_common, "have_changed":have_changed, "unchanged":are_unchanged, "mapping_by_hashes":hashmap}
+                result_dict = {"directories":[args.new_dir, args.orig_dir], "new_files":are_new, "common_files":are_common, "have_changed":have_changed, "unchanged":are_unchanged, "hash_algorithm":fileInfo.hash_algorithm, "mapping_by_hashes":hashmap}
             else:
                 result_dict = {"directories":[args.new_dir, args.orig_dir], "new_files":are_new, "common_files":are_common, "have_changed":have_changed, "unchanged":are_unchanged}
             write_to_JSON(result_dict, args.outfile)